@@ -1,272 +1,372 @@
 import requests
-
-import grequests  # used for asynchronous/parallel queries
-from pymarc import Record, Field, record_to_xml, Subfield
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # rust-based parser, considerably faster than the stdlib
+except ImportError:
+    import json as orjson
+
+import collections
+import concurrent.futures
+import functools
+import contextlib
 import datetime
 import logging
+import os
 import re
 import math
+import queue
+import shelve
+import threading
+
+from lxml import etree
 
 from harvesters.helper import MARCXML_OPENING_ELEMENTS, MARCXML_CLOSING_ELEMENTS
 
 
+@functools.lru_cache(maxsize=131072)
+def _heading_subfield_bytes(title, language):
+    # Parent names like countries or regions repeat across thousands of records, so the
+    # serialized heading subfields are memoized on (title, language).
+    if language == '':
+        return b'\x1fa' + title.encode('utf-8')
+    else:
+        return b'\x1fa' + title.encode('utf-8') + b'\x1fl' + language.encode('utf-8')
+
+
+def _add_heading_subfields(field, data):
+    etree.SubElement(field, 'subfield', code='a').text = data['title']
+    if 'language' in data and data['language'] != '':
+        etree.SubElement(field, 'subfield', code='l').text = data['language']
+
+
+class CachedPlace:
+    """Slimmed down place document, keeping only the fields read when building records.
+
+    The raw JSON documents carry dozens of keys (geometry, provenance, links, ...) that are
+    never read again once cached; storing them as slotted objects cuts per-place memory
+    considerably on large harvests."""
+
+    __slots__ = ('gaz_id', 'id', 'pref_name', 'names', 'parent', 'ancestors', 'access_denied')
+
+    def __init__(self, place):
+        self.gaz_id = place.get('gazId')
+        self.id = place.get('@id')
+        self.pref_name = place.get('prefName')
+        self.names = place.get('names', [])
+        self.parent = place.get('parent')
+        self.ancestors = place.get('ancestors', [])
+        self.access_denied = place.get('accessDenied', False)
+
+
 class GazetteerHarvester:
+    __slots__ = ('logger', 'timeframe_query', '_cached_places', '_processed_batches_counter',
+                 '_etag_cache', '_session', '_executor', '_output_path', '_output_file', '_format',
+                 '_field_008_data', '_field_008_bytes')
+
     _base_url = 'https://gazetteer.dainst.org'
-    _output_file = None
-    _file_writer = None
-    _cached_places = dict()
     _batch_size = 50
-    _processed_batches_counter = 0
+    _max_cached_places = 50000
+    _max_parallel_requests = 16
     _gazId_pattern = re.compile('.*/place/(\d+)$')
 
-    def _scrub_coordinates_and_polygons(self, place):
-        if 'prefLocation' in place:
-            del place['prefLocation']
-        if 'locations' in place:
-            del place['locations']
+    # Everything after the date in the 008 fixed-length data elements is constant.
+    _field_008_suffix = '||||zzz||||d          || bn|      '
 
-        return place
+    # Serialized bytes of the constant 003 and 040 fields, shared by every record.
+    _field_003_bytes = b'DE-2553\x1e'
+    _field_040_bytes = '  \x1faDeutsches Archäologisches Institut\x1e'.encode('utf-8')
 
     def _extract_gaz_id_from_url(self, url):
+        # rpartition is a C-level scan and much cheaper than the regex; keep the
+        # regex as fallback in case the URL deviates from the '/place/<id>' shape.
+        tail = url.rpartition('/place/')[2]
+        if tail.isdigit():
+            return tail
+
         match = self._gazId_pattern.match(url)
         return match.group(1)
 
+    def _cache_put(self, uri, place):
+        # Simple LRU eviction: ancestor reuse is strongly clustered within adjacent batches, so
+        # dropping the least recently used entries keeps the hit rate high while bounding memory.
+        if uri in self._cached_places:
+            self._cached_places.move_to_end(uri)
+        self._cached_places[uri] = CachedPlace(place)
+        if len(self._cached_places) > self._max_cached_places:
+            self._cached_places.popitem(last=False)
+
+    def _conditional_headers(self, url):
+        cached = self._etag_cache.get(url)
+        if cached is not None:
+            return {'If-None-Match': cached[0]}
+        return None
+
+    def _response_content(self, response):
+        # Place documents change rarely; on 304 Not Modified reuse the body stored with the
+        # document's ETag during an earlier run instead of transferring it again.
+        if response.status_code == 304:
+            return self._etag_cache[response.url][1]
+
+        etag = response.headers.get('ETag')
+        if etag is not None:
+            self._etag_cache[response.url] = (etag, response.content)
+        return response.content
+
     def _retry_query(self, url, retries_left):
-        self.logger.info("  Retrying {0}...".format(url))
+        self.logger.info("  Retrying %s...", url)
         try:
             if retries_left == 0:
-                self.logger.info("  No retries left for {0}.".format(url))
+                self.logger.info("  No retries left for %s.", url)
                 return None
             else:
-                response = requests.get(url=url)
+                response = self._session.get(url=url, timeout=(5, 30))
                 response.raise_for_status()
                 self.logger.info("  Retry successful.")
-                return response.json()
+                return orjson.loads(response.content)
         except Exception as e:
             self._handle_query_exception(e, retries_left - 1)
 
     def _handle_query_exception(self, e, retries_left):
-        self.logger.error(e)
         if type(e) is ValueError:
-            self.logger.error("JSON decoding fails!")
+            self.logger.error("JSON decoding fails: %s", e)
         elif type(e) is requests.exceptions.RequestException:
-            self.logger.error("Gazetteer service request fails!")
-            self.logger.error("Request: {0}".format(e.request))
-            self.logger.error("Response: {0}".format(e.response))
+            self.logger.error("Gazetteer service request fails: %s", e)
+            self.logger.error("Request: %s", e.request)
+            self.logger.error("Response: %s", e.response)
         elif type(e) is requests.exceptions.HTTPError and e.response.status_code == 500:
+            self.logger.error(e)
             return self._retry_query(e.request.url, retries_left)
         elif type(e) is requests.exceptions.ConnectionError:
+            self.logger.error(e)
             return self._retry_query(e.request.url, retries_left)
+        else:
+            self.logger.error(e)
 
-    def _create_marc_record(self, place):
-        def create_x51_heading_subfield(data):
-            if 'language' not in data or data['language'] == '':
-                return [Subfield(code='a', value=data['title'])]
-            else:
-                return [Subfield(code='a', value=data['title']), Subfield(code='l', value=data['language'])]
-
-        field_001 = Field(tag='001', data="iDAI.gazetteer-{0}".format(place['gazId']))
-        field_003 = Field(tag='003', data="DE-2553")
-
-        fixed_length_data_elements = datetime.date.today().isoformat().replace('-', '')
-        fixed_length_data_elements += '|'           # index 6
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += 'z'
-        fixed_length_data_elements += 'z'           # 11
-        fixed_length_data_elements += 'z'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += 'd'           # 17
-        fixed_length_data_elements += '          '  # 27
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += ' '
-        fixed_length_data_elements += 'b'
-        fixed_length_data_elements += 'n'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '    '        # 37
-        fixed_length_data_elements += ' '
-        fixed_length_data_elements += ' '
-        field_008 = Field(tag='008', data=fixed_length_data_elements)
-
-        field_024 = Field(
-            tag=24, indicators=(7, ' '), subfields=[
-                Subfield(
-                    code='a', value=place['gazId'],
-                ),
-                Subfield(
-                    code='2', value="iDAI.gazetteer"
-                ),
-                Subfield(
-                    code='9', value="iDAI.gazetteer-{0}".format(place['gazId'])
-                )
-            ]
-        )
-
-        field_040 = Field(
-            tag=40, indicators=(' ', ' '), subfields=[
-                Subfield(
-                    code='a', value='Deutsches Archäologisches Institut'
-                )
-            ]
-        )
+    def _emit_marc_bytes(self, place):
+        # Binary MARC serialization without going through pymarc's Field/Record objects, which
+        # dominate per-record CPU time.
+        def heading_subfields(data):
+            return _heading_subfield_bytes(data['title'], data.get('language', ''))
 
-        if 'prefName' in place:
-            field_151 = Field(
-                tag=151, indicators=(' ', ' '), subfields=create_x51_heading_subfield(place['prefName']) + [
-                    Subfield(code='1', value="{0}/doc/{1}".format(self._base_url, place['gazId']))
-                ]
-            )
-        else:
+        if 'prefName' not in place:
             self.logger.warning("No 'prefName' for place:")
             self.logger.warning(place)
             return None
 
-        fields_451 = []
-        if 'names' in place:
-            for variant_name in place['names']:
-                fields_451.append(Field(
-                    tag=451, indicators=(' ', ' '), subfields=create_x51_heading_subfield(variant_name)
-                ))
+        gaz_id = place['gazId']
+        identifier_bytes = "iDAI.gazetteer-{0}".format(gaz_id).encode('utf-8')
+
+        fields = [
+            (b'001', identifier_bytes + b'\x1e'),
+            (b'003', self._field_003_bytes),
+            (b'008', self._field_008_bytes),
+            (b'024', b'7 \x1fa' + str(gaz_id).encode('utf-8')
+             + b'\x1f2iDAI.gazetteer'
+             + b'\x1f9' + identifier_bytes + b'\x1e'),
+            (b'040', self._field_040_bytes),
+            (b'151', b'  ' + heading_subfields(place['prefName'])
+             + b'\x1f1' + "{0}/doc/{1}".format(self._base_url, gaz_id).encode('utf-8') + b'\x1e'),
+        ]
+
+        for variant_name in place.get('names', []):
+            fields.append((b'451', b'  ' + heading_subfields(variant_name) + b'\x1e'))
 
         order = 1
-        fields_551 = []
-        added_parents = []
-        if 'parent' in place:
-            parent_uri = place['parent']
-            while parent_uri is not None:
-
-                if parent_uri not in self._cached_places:
-                    self.logger.debug("Parent:{0}/doc/{1}.json not in cached places!"
-                                      .format(self._base_url, self._extract_gaz_id_from_url(parent_uri)))
-                    self.logger.debug("Child: {0}/doc/{1}.json"
-                                      .format(self._base_url, self._extract_gaz_id_from_url(place['@id'])))
-                    self.logger.debug("...running additional query.")
-
-                    url = "{0}/doc/{1}.json".format(self._base_url, self._extract_gaz_id_from_url(parent_uri))
-
-                    response = requests.get(url)
-                    parent = response.json()
-                    self._cached_places[parent_uri] = self._scrub_coordinates_and_polygons(parent)
-
-                current = self._cached_places[parent_uri]
-
-                if 'prefName' in current:
-                    fields_551.append(Field(
-                        tag=551, indicators=(' ', ' '), subfields=create_x51_heading_subfield(current['prefName']) + [
-                            Subfield(code='x', value="part of"), 
-                            Subfield(code='i', value="{0}".format(order)), 
-                            Subfield(code='0', value="iDAI.gazetteer-{0}".format(current['gazId']))
-                        ]
-                    ))
-                elif 'accessDenied' in current and current['accessDenied'] is True:
-                    break
-                else:
-                    self.logger.warning("No prefName for: {0}/doc/{1}.json".format(self._base_url, current['gazId']))
+        for ancestor_uri in place.get('ancestors', []):
+            # Single atomic get: the producer thread may evict cache entries between a
+            # membership test and a subscript on this thread.
+            current = self._cached_places.get(ancestor_uri)
+            if current is None:
+                self.logger.error("Ancestor %s/doc/%s.json of %s/doc/%s.json missing from cache, "
+                                  "skipping remaining ancestors.",
+                                  self._base_url, self._extract_gaz_id_from_url(ancestor_uri),
+                                  self._base_url, place['gazId'])
+                break
+
+            if current.access_denied is True:
+                break
+            elif current.pref_name is not None:
+                fields.append((b'551', b'  ' + heading_subfields(current.pref_name)
+                               + b'\x1fxpart of'
+                               + b'\x1fi' + str(order).encode('utf-8')
+                               + b'\x1f0' + "iDAI.gazetteer-{0}".format(current.gaz_id).encode('utf-8')
+                               + b'\x1e'))
+            else:
+                self.logger.warning("No prefName for: %s/doc/%s.json", self._base_url, current.gaz_id)
+
+            order += 1
+
+        directory = bytearray()
+        field_data = bytearray()
+        offset = 0
+        for tag, data in fields:
+            directory += tag + "{0:04d}{1:05d}".format(len(data), offset).encode('utf-8')
+            field_data += data
+            offset += len(data)
+        directory += b'\x1e'
+
+        base_address = 24 + len(directory)
+        record_length = base_address + len(field_data) + 1
+        leader = "{0:05d}".format(record_length).encode('utf-8') \
+            + b' z  a' \
+            + "22{0:05d}".format(base_address).encode('utf-8') \
+            + b'   4500'
+
+        return bytes(leader + directory + field_data + b'\x1d')
+
+    def _emit_marcxml_bytes(self, place):
+        # Like _emit_marc_bytes, but building the MARCXML record with lxml's C-level element
+        # construction instead of pymarc's pure-Python record_to_xml.
+        def add_datafield(record_el, tag, ind1=' ', ind2=' '):
+            return etree.SubElement(record_el, 'datafield', tag=tag, ind1=ind1, ind2=ind2)
+
+        if 'prefName' not in place:
+            self.logger.warning("No 'prefName' for place:")
+            self.logger.warning(place)
+            return None
 
-                order += 1
-                added_parents += [parent_uri]
+        gaz_id = place['gazId']
+        identifier = "iDAI.gazetteer-{0}".format(gaz_id)
 
-                if 'parent' in current:
-                    if current['parent'] in added_parents:
-                        self.logger.error("Tried adding {0} as a parent a second time. This should not happen.".format(parent_uri))
-                        self.logger.error("Gazetteer ID: {0}".format(place['gazId']))
-                        parent_uri = None
-                    else:
-                        parent_uri = current['parent']
-                else:
-                    parent_uri = None
+        record_el = etree.Element('record')
+        etree.SubElement(record_el, 'leader').text = '      z  a22        4500'
+        etree.SubElement(record_el, 'controlfield', tag='001').text = identifier
+        etree.SubElement(record_el, 'controlfield', tag='003').text = 'DE-2553'
+        etree.SubElement(record_el, 'controlfield', tag='008').text = self._field_008_data
 
-        record = Record(force_utf8=True)
-        record.leader = record.leader[0:6] + 'z' + record.leader[7:]
-        record.add_field(field_001)
-        record.add_field(field_003)
-        record.add_field(field_008)
-        record.add_field(field_024)
-        record.add_field(field_040)
+        field_024 = add_datafield(record_el, '024', ind1='7')
+        etree.SubElement(field_024, 'subfield', code='a').text = str(gaz_id)
+        etree.SubElement(field_024, 'subfield', code='2').text = 'iDAI.gazetteer'
+        etree.SubElement(field_024, 'subfield', code='9').text = identifier
 
-        record.add_field(field_151)
+        field_040 = add_datafield(record_el, '040')
+        etree.SubElement(field_040, 'subfield', code='a').text = 'Deutsches Archäologisches Institut'
 
-        if fields_451:
-            for field in fields_451:
-                record.add_field(field)
+        field_151 = add_datafield(record_el, '151')
+        _add_heading_subfields(field_151, place['prefName'])
+        etree.SubElement(field_151, 'subfield', code='1').text = \
+            "{0}/doc/{1}".format(self._base_url, gaz_id)
 
-        if fields_551:
-            for field in fields_551:
-                record.add_field(field)
+        for variant_name in place.get('names', []):
+            _add_heading_subfields(add_datafield(record_el, '451'), variant_name)
 
-        return record
+        order = 1
+        for ancestor_uri in place.get('ancestors', []):
+            # Single atomic get: the producer thread may evict cache entries between a
+            # membership test and a subscript on this thread.
+            current = self._cached_places.get(ancestor_uri)
+            if current is None:
+                self.logger.error("Ancestor %s/doc/%s.json of %s/doc/%s.json missing from cache, "
+                                  "skipping remaining ancestors.",
+                                  self._base_url, self._extract_gaz_id_from_url(ancestor_uri),
+                                  self._base_url, place['gazId'])
+                break
+
+            if current.access_denied is True:
+                break
+            elif current.pref_name is not None:
+                field_551 = add_datafield(record_el, '551')
+                _add_heading_subfields(field_551, current.pref_name)
+                etree.SubElement(field_551, 'subfield', code='x').text = 'part of'
+                etree.SubElement(field_551, 'subfield', code='i').text = str(order)
+                etree.SubElement(field_551, 'subfield', code='0').text = \
+                    "iDAI.gazetteer-{0}".format(current.gaz_id)
+            else:
+                self.logger.warning("No prefName for: %s/doc/%s.json", self._base_url, current.gaz_id)
+
+            order += 1
+
+        return etree.tostring(record_el)
 
-    def _write_place(self, place):
+    def _serialize_place(self, place):
 
-        record = self._create_marc_record(place)
+        if self._format == 'marc':
+            serialized = self._emit_marc_bytes(place)
+        else:
+            serialized = self._emit_marcxml_bytes(place)
 
-        if record is None:
+        if serialized is None:
             self.logger.warning("Skipping place:")
             self.logger.warning(place)
-        elif self._format == 'marc':
-            self._output_file.write(record.as_marc())
-        elif self._format == 'marcxml':
-            self._output_file.write(record_to_xml(record))
 
-    def _collect_places_data(self, batch):
-        self.logger.info("Retrieving place data for batch #{0}...".format(self._processed_batches_counter + 1))
-        url_list = []
-        for item in batch:
-            if item['@id'] in self._cached_places:
-                continue
-            url_list.append("{0}/doc/{1}.json".format(self._base_url, item["gazId"]))
+        return serialized
 
-        places = []
+    def _write_places(self, places):
+        # Coalesce each batch into a single write call instead of one syscall per record.
+        chunks = [serialized for serialized in map(self._serialize_place, places) if serialized is not None]
 
-        try:
-            rs = [grequests.get(url) for url in url_list]
-            responses = grequests.map(rs)
-            for response in responses:
-                if response is None:
-                    continue
+        if chunks:
+            self._output_file.write(b''.join(chunks))
 
+    def _fetch_place_docs(self, urls):
+        docs = []
+
+        futures = [
+            self._executor.submit(self._session.get, url, headers=self._conditional_headers(url), timeout=(5, 30))
+            for url in urls
+        ]
+        # Handle every response in its own try/except so a single failed query no longer
+        # discards the remainder of the batch.
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                response = future.result()
                 response.raise_for_status()
-                place = response.json()
+                place = orjson.loads(self._response_content(response))
+            except Exception as e:
+                # The retry path returns the parsed document when it recovers the query;
+                # keep it like a first-try success instead of dropping it.
+                place = self._handle_query_exception(e, 5)
+                if not isinstance(place, dict) or '@id' not in place:
+                    continue
 
-                self._cached_places[place['@id']] = self._scrub_coordinates_and_polygons(place)
+            self._cache_put(place['@id'], place)
 
-                places.append(place)
-        except Exception as e:
-            self._handle_query_exception(e, 5)
+            docs.append(place)
 
-        # Also load parent and ancestor places of the current batch (in case they are not already cached)
-        url_list = []
-        for place in places:
+        return docs
+
+    def _missing_ancestor_urls(self, docs):
+        # Ancestor chains overlap heavily between places, so collect the URLs as a set right away.
+        url_set = set()
+        for place in docs:
             if 'parent' in place and place['parent'] not in self._cached_places:
-                url_list.append(
+                url_set.add(
                     "{0}/doc/{1}.json".format(self._base_url, self._extract_gaz_id_from_url(place["parent"]))
                 )
-            if 'ancestors' in place:
-                for ancestor in place['ancestors']:
-                    if ancestor not in self._cached_places:
-                        url_list.append(
-                            "{0}/doc/{1}.json".format(self._base_url, self._extract_gaz_id_from_url(ancestor))
-                        )
+            for ancestor in place.get('ancestors', []):
+                if ancestor not in self._cached_places:
+                    url_set.add(
+                        "{0}/doc/{1}.json".format(self._base_url, self._extract_gaz_id_from_url(ancestor))
+                    )
 
-        url_list = list(set(url_list))
+        return url_set
 
-        try:
-            rs = [grequests.get(url) for url in url_list]
-            responses = grequests.map(rs)
-            for response in responses:
-                response.raise_for_status()
-                place = response.json()
+    def _collect_places_data(self, batch):
+        self.logger.info("Retrieving place data for batch #%s...", self._processed_batches_counter + 1)
+        url_list = [
+            "{0}/doc/{1}.json".format(self._base_url, item["gazId"])
+            for item in batch if item['@id'] not in self._cached_places
+        ]
 
-                places.append(place)
+        places = self._fetch_place_docs(url_list)
 
-                self._cached_places[place['@id']] = self._scrub_coordinates_and_polygons(place)
-        except Exception as e:
-            self._handle_query_exception(e, 5)
+        # Also load parent and ancestor places of the current batch (in case they are not already cached).
+        ancestor_docs = self._fetch_place_docs(self._missing_ancestor_urls(places))
+        places.extend(ancestor_docs)
+
+        # Fetch transitively until the cache covers every chain completely, so record building
+        # never has to fall back to a synchronous query. Further rounds only populate the cache;
+        # the loop terminates because failed documents cannot reference new ancestors.
+        while ancestor_docs:
+            ancestor_docs = self._fetch_place_docs(self._missing_ancestor_urls(ancestor_docs))
+
+        for place in places:
+            for ancestor in place.get('ancestors', []):
+                if ancestor not in self._cached_places:
+                    self.logger.error("Ancestor %s of place %s could not be prefetched.",
+                                      ancestor, place['@id'])
 
         self._processed_batches_counter += 1
         return places
@@ -280,14 +380,30 @@ class GazetteerHarvester:
                 .format(self._base_url, self._batch_size, scroll_id, self.timeframe_query)
 
         try:
-            response = requests.get(url=url)
+            response = self._session.get(url=url, timeout=(5, 30))
             response.raise_for_status()
-            return response.json()
+            return orjson.loads(response.content)
         except Exception as e:
-            self._handle_query_exception(e, 5)
+            return self._handle_query_exception(e, 5)
+
+    def _produce_place_batches(self, batch, scroll_id, batch_queue, failure):
+        # Producer half of the scroll pipeline. Scroll pagination is sequential by design (each
+        # page is only addressable via the scrollId returned with its predecessor), so search
+        # pages cannot be fanned out in parallel; instead the whole fetch-and-collect stage runs
+        # ahead of the writer, bounded by the queue size. All cache mutation stays on this thread.
+        # Failures are handed to the writer thread so the harvest does not report success.
+        try:
+            while batch['result']:
+                batch_queue.put(self._collect_places_data(batch['result']))
+                batch = self._get_batch(scroll_id)
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            batch_queue.put(None)
 
     def start(self):
-        with open(self._output_path, 'wb') as output_file:
+        with self._session, self._executor, contextlib.closing(self._etag_cache), \
+                open(self._output_path, 'wb', buffering=1 << 20) as output_file:
             self._output_file = output_file
             if self._format == 'marcxml':
                 self._output_file.write(MARCXML_OPENING_ELEMENTS)
@@ -296,21 +412,33 @@ class GazetteerHarvester:
             total = batch['total']
             scroll_id = batch['scrollId']
 
-            self.logger.info("{0} places in query total.".format(total))
-            self.logger.info("Number of batches: {0}".format(math.ceil(total / self._batch_size)))
-            places = self._collect_places_data(batch['result'])
-
-            for place in places:
-                self._write_place(place)
+            self.logger.info("%s places in query total.", total)
+            self.logger.info("Number of batches: %s", math.ceil(total / self._batch_size))
+
+            # Bounded handover queue: network collection runs up to two batches ahead of the
+            # serialization and file writing happening on this thread.
+            batch_queue = queue.Queue(maxsize=2)
+            producer_failure = []
+            # daemon=True so that a writer failure on this thread cannot hang the process:
+            # with no consumer left, the producer would block forever in put() on the full
+            # queue (even its None sentinel) and a non-daemon thread would keep the
+            # interpreter alive indefinitely.
+            producer = threading.Thread(
+                target=self._produce_place_batches, args=(batch, scroll_id, batch_queue, producer_failure),
+                name='place-batch-producer', daemon=True
+            )
+            producer.start()
 
-            next_batch = self._get_batch(scroll_id)
-            while next_batch['result']:
-                places = self._collect_places_data(next_batch['result'])
+            while True:
+                places = batch_queue.get()
+                if places is None:
+                    break
+                self._write_places(places)
 
-                for place in places:
-                    self._write_place(place)
+            producer.join()
 
-                next_batch = self._get_batch(scroll_id)
+            if producer_failure:
+                raise producer_failure[0]
 
             if self._format == 'marcxml':
                 self._output_file.write(MARCXML_CLOSING_ELEMENTS)
@@ -320,6 +448,28 @@ class GazetteerHarvester:
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.INFO)
 
+        self._cached_places = collections.OrderedDict()
+        self._processed_batches_counter = 0
+
+        # The 008 field only depends on the day the harvest runs, so build it once.
+        self._field_008_data = datetime.date.today().isoformat().replace('-', '') + self._field_008_suffix
+        self._field_008_bytes = self._field_008_data.encode('utf-8') + b'\x1e'
+
+        # ETag cache shared between runs, stored next to the dated output directories (like the
+        # last_run_date log written by main).
+        self._etag_cache = shelve.open(
+            os.path.join(os.path.dirname(os.path.normpath(output_directory)), 'gazetteer_etag_cache')
+        )
+
+        # Parallel queries run on a bounded thread pool sharing the pooled session below.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_parallel_requests)
+
+        # Reuse pooled keep-alive connections instead of opening a fresh TCP+TLS connection per query.
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(
+            pool_connections=32, pool_maxsize=64, max_retries=Retry(total=3, backoff_factor=0.2)
+        ))
+
         if start_date is None:
             self.timeframe_query = ''
         else:
@@ -331,7 +481,7 @@ class GazetteerHarvester:
         elif output_format == 'marcxml':
             suffix = '.marcxml'
         else:
-            self.logger.error("Unknown format: {0}, aborting.".format(output_format))
+            self.logger.error("Unknown format: %s, aborting.", output_format)
             return
 
         self._output_path = "{0}gazetteer_authority{1}".format(output_directory, suffix)
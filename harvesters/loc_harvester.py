@@ -1,20 +1,37 @@
 import requests
-import grequests  # used for asynchronous/parallel queries
-from pymarc import record_to_xml, marcxml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import concurrent.futures
+from pymarc import marcxml
 import datetime
 import logging
-import dateutil.parser
 
 
 from lxml import etree
-from io import BytesIO, StringIO
+from io import BytesIO
 
 from harvesters.helper import MARCXML_OPENING_ELEMENTS, MARCXML_CLOSING_ELEMENTS
 
 
+def _serialize_entry_marc(record, content):
+    return record.as_marc()
+
+
+def _serialize_entry_marcxml(record, content):
+    # The response body already is the MARCXML record; reuse it instead of rebuilding the XML
+    # from the parsed record, stripping the declaration so it nests inside the collection element.
+    declaration_end = content.find(b'?>')
+    if declaration_end != -1:
+        content = content[declaration_end + 2:]
+    return content.strip()
+
+
 class LocHarvester:
 
-    _NS = {'default': "http://www.w3.org/2005/Atom"}
+    _ATOM_ENTRY_TAG = '{http://www.w3.org/2005/Atom}entry'
+    _ATOM_LINK_TAG = '{http://www.w3.org/2005/Atom}link'
+    _ATOM_UPDATED_TAG = '{http://www.w3.org/2005/Atom}updated'
 
     _subscribed_feeds = [
         "http://id.loc.gov/authorities/names/feed/",
@@ -26,27 +43,45 @@ class LocHarvester:
     _start_date = None
     _file_suffix = None
     _batch_size = 300
+    _heading_tags = frozenset({'100', '110', '111', '130'})
+    _feed_page_window = 8
+    _max_parallel_requests = 16
 
     def _collect_entries_since_start_date(self, feed, start_date):
 
         result = []
 
+        # Fetch feed pages in speculative windows instead of one synchronous round-trip per
+        # page; like before, the walk stops at the first page without entries in the timeframe
+        # (at the price of up to window - 1 prefetched pages beyond it).
         feed_page_index = 1
-        feed_items = self._read_feed("{0}{1}".format(feed, feed_page_index), start_date)
-        feed_page_index += 1
-
-        result.extend(feed_items)
-
-        while feed_items:
-            feed_items = self._read_feed("{0}{1}".format(feed, feed_page_index), start_date)
-            feed_page_index += 1
-            result.extend(feed_items)
+        proceed = True
+        while proceed:
+            futures = [
+                self._executor.submit(self._read_feed, "{0}{1}".format(feed, page), start_date)
+                for page in range(feed_page_index, feed_page_index + self._feed_page_window)
+            ]
+            for future in futures:
+                feed_items, reached_stale_entry = future.result()
+                result.extend(feed_items)
+                # Once a page is empty or ends in an entry older than the start date, every
+                # following page is out of range as well.
+                if reached_stale_entry or not feed_items:
+                    proceed = False
+                    break
+
+            feed_page_index += self._feed_page_window
 
         # If an entry was edited twice or more within the harvested timespan, it will show up multiple times in the
-        # result list.
-        self.logger.debug("Filtering duplicate results, current:  {0}".format(len(result)))
-        result = list(set(result))
-        self.logger.debug("                             filtered: {0}".format(len(result)))
+        # result list, each time with a different timestamp. Keep one entry per link (its latest date);
+        # the tuple-based set only removed exact (link, date) duplicates and left such entries in.
+        self.logger.debug("Filtering duplicate results, current:  %s", len(result))
+        deduplicated = {}
+        for link, timestamp in result:
+            if timestamp > deduplicated.get(link, ''):
+                deduplicated[link] = timestamp
+        result = list(deduplicated.items())
+        self.logger.debug("                             filtered: %s", len(result))
 
         return result
 
@@ -54,86 +89,67 @@ class LocHarvester:
 
         records = []
 
-        try:
-            rs = [grequests.get(url) for (url, _date) in link_list]
-            responses = grequests.map(rs)
-            for response in responses:
-                if response is None:
-                    continue
-
+        futures = [
+            self._executor.submit(self._session.get, url, timeout=(5, 30)) for (url, _date) in link_list
+        ]
+        # Handle every response in its own try/except so a single failed query no longer
+        # discards the remainder of the batch. Transient errors are already retried with
+        # backoff by the urllib3 Retry policy mounted on the session; whatever still fails
+        # here is logged and skipped.
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                response = future.result()
                 response.raise_for_status()
-                record = marcxml.parse_xml_to_array(StringIO(BytesIO(response.content).read().decode('UTF-8')))[0]
-                records.append(record)
-            return records
-        except Exception as e:
-            self._handle_query_exception(e, 5)
-
-    def _retry_query(self, url, retries_left):
-        self.logger.info("  Retrying {0}...".format(url))
-        try:
-            if retries_left == 0:
-                self.logger.info("  No retries left for {0}.".format(url))
-                return None
-            else:
-                response = requests.get(url=url)
-                response.raise_for_status()
-                self.logger.info("  Retry successful.")
-                return response.json()
-        except Exception as e:
-            self._handle_query_exception(e, retries_left - 1)
-
-    def _handle_query_exception(self, e, retries_left):
-        return self._retry_query(e.request.url, retries_left)
+                record = marcxml.parse_xml_to_array(BytesIO(response.content))[0]
+                records.append((record, response.content))
+            except Exception as e:
+                self.logger.error("Collecting entry fails: %s", e)
+        return records
 
     def _read_feed(self, url, min_date):
-        res = requests.get(url, headers={"Accept": "application/xml"}, cookies={"Cookie": "?"})
-
-        xml_element_tree = etree.parse(BytesIO(res.content))
-
-        entries = xml_element_tree.xpath(
-            "//default:entry", namespaces=self._NS
-        )
+        # ISO-8601 dates compare lexicographically, so the timeframe check only needs the date
+        # prefix of the Atom timestamp instead of a full parser invocation per entry.
+        min_date_iso = min_date.isoformat()[:10]
 
         result = []
-        for entry in entries:
-            link = entry.xpath(
-                './default:link[@rel="alternate" and @type="application/marc+xml"]/@href', namespaces=self._NS
-            )[0]
-            timestamp = entry.xpath(
-                './default:updated/text()', namespaces=self._NS
-            )[0]
-
-            date = datetime.datetime.combine(dateutil.parser.parse(timestamp, ignoretz=True), datetime.datetime.min.time())
+        reached_stale_entry = False
+        # Stream the response body into the parser entry by entry instead of materializing the
+        # whole feed page; processed entries are cleared right away. Feed entries are sorted by
+        # update time (newest first), so parsing stops at the first entry outside the timeframe
+        # and the caller is told to stop paging as well.
+        with self._session.get(url, headers={"Accept": "application/xml"}, cookies={"Cookie": "?"},
+                               timeout=(5, 30), stream=True) as res:
+            res.raw.decode_content = True
+            for _event, entry in etree.iterparse(res.raw, events=('end',), tag=self._ATOM_ENTRY_TAG):
+                link = None
+                timestamp = None
+                for child in entry:
+                    if child.tag == self._ATOM_LINK_TAG \
+                            and child.get('rel') == 'alternate' and child.get('type') == 'application/marc+xml':
+                        link = child.get('href')
+                    elif child.tag == self._ATOM_UPDATED_TAG:
+                        timestamp = child.text
+                entry.clear(keep_tail=True)
+
+                if link is None or timestamp is None:
+                    continue
 
-            if date < min_date:
-                continue
+                if timestamp[:10] < min_date_iso:
+                    reached_stale_entry = True
+                    break
 
-            result.append((link, date))
+                result.append((link, timestamp))
 
-        return result
+        return result, reached_stale_entry
 
     def _write_records(self, records, file_handler_mapping):
-        for record in records:
-            if record.get_fields('100'):
-                if self._format == 'marc':
-                    file_handler_mapping['100'].write(record.as_marc())
-                elif self._format == 'marcxml':
-                    file_handler_mapping['100'].write(record_to_xml(record))
-            elif record.get_fields('110'):
-                if self._format == 'marc':
-                    file_handler_mapping['110'].write(record.as_marc())
-                elif self._format == 'marcxml':
-                    file_handler_mapping['110'].write(record_to_xml(record))
-            elif record.get_fields('111'):
-                if self._format == 'marc':
-                    file_handler_mapping['111'].write(record.as_marc())
-                elif self._format == 'marcxml':
-                    file_handler_mapping['111'].write(record_to_xml(record))
-            elif record.get_fields('130'):
-                if self._format == 'marc':
-                    file_handler_mapping['130'].write(record.as_marc())
-                elif self._format == 'marcxml':
-                    file_handler_mapping['130'].write(record_to_xml(record))
+        # One pass over each record's fields instead of up to four get_fields scans; the
+        # output format is resolved once in __init__ via self._serialize_entry.
+        for record, content in records:
+            for field in record.fields:
+                if field.tag in self._heading_tags:
+                    file_handler_mapping[field.tag].write(self._serialize_entry(record, content))
+                    break
 
     def start(self):
 
@@ -141,10 +157,11 @@ class LocHarvester:
             self.logger.warning("Harvesting without start date is not supported, aborting.")
             return
 
-        with open("{0}loc_personal_names{1}".format(self._output_directory, self._suffix), 'wb') as personal_names_fh, \
-             open("{0}loc_corporate_names{1}".format(self._output_directory, self._suffix), 'wb') as corporate_names_fh, \
-             open("{0}loc_meeting_names{1}".format(self._output_directory, self._suffix), 'wb') as meeting_names_fh, \
-             open("{0}loc_uniform_titles{1}".format(self._output_directory, self._suffix), 'wb') as uniform_titles_fh:
+        with self._session, self._executor, \
+             open("{0}loc_personal_names{1}".format(self._output_directory, self._suffix), 'wb', buffering=1 << 20) as personal_names_fh, \
+             open("{0}loc_corporate_names{1}".format(self._output_directory, self._suffix), 'wb', buffering=1 << 20) as corporate_names_fh, \
+             open("{0}loc_meeting_names{1}".format(self._output_directory, self._suffix), 'wb', buffering=1 << 20) as meeting_names_fh, \
+             open("{0}loc_uniform_titles{1}".format(self._output_directory, self._suffix), 'wb', buffering=1 << 20) as uniform_titles_fh:
 
             heading_to_file_handler = \
                 {
@@ -159,7 +176,7 @@ class LocHarvester:
                     heading_to_file_handler[key].write(MARCXML_OPENING_ELEMENTS)
 
             for feed in self._subscribed_feeds:
-                self.logger.info("Reading feed: {0}.".format(feed))
+                self.logger.info("Reading feed: %s.", feed)
                 entry_links = self._collect_entries_since_start_date(feed, self._start_date)
 
                 batched_list = []
@@ -167,15 +184,11 @@ class LocHarvester:
                     batched_list.append(entry_links[i:i + self._batch_size])
 
                 self.logger.info("Collecting entry data batches and writing results to file. "
-                                 "({1} entries in {1} batches)".format(len(entry_links), len(batched_list)))
+                                 "(%s entries in %s batches)", len(entry_links), len(batched_list))
                 counter = 1
                 for batch in batched_list:
-                    self.logger.info("  Processing batch #{0} of {1}.".format(counter, len(batched_list)))
-                    batch_records = self._collect_entry_data(batch)
-                    if batch_records is not None:
-                        self._write_records(batch_records, heading_to_file_handler)
-                    else:
-                        self.logger.info("  No records written for batch #{0}.".format(counter))
+                    self.logger.info("  Processing batch #%s of %s.", counter, len(batched_list))
+                    self._write_records(self._collect_entry_data(batch), heading_to_file_handler)
                     counter += 1
 
             if self._format == 'marcxml':
@@ -186,16 +199,28 @@ class LocHarvester:
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.INFO)
 
+        # Parallel queries run on a bounded thread pool sharing the pooled session below.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_parallel_requests)
+
+        # Reuse pooled keep-alive connections instead of opening a fresh connection per query.
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32, pool_maxsize=64,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504))
+        )
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
         if start_date is None:
             self.logger.warning("Harvesting without start date is not supported.")
 
         # LoC applies changes at 5:00 EST, which would be 11:00 local time in Berlin.
         # We won't be running the script in the daytime, so we force the script to look for timestamps actually one day
         # earlier than actually requested. TODO: Maybe find generalized solution (without expecting UTC+1 timezone)
-        if datetime.datetime.now().time().hour < 12:
+        if start_date is not None and datetime.datetime.now().time().hour < 12:
             new_date = start_date - datetime.timedelta(days=1)
             self.logger.warning("Script running before LoC applies changes to their update feed, "
-                                "also harvesting changes from {0}.".format(new_date.isoformat()))
+                                "also harvesting changes from %s.", new_date.isoformat())
             self._start_date = new_date
         else:
             self._start_date = start_date
@@ -207,3 +232,7 @@ class LocHarvester:
             self._suffix = '.marcxml'
 
         self._format = output_format
+        if output_format == 'marc':
+            self._serialize_entry = _serialize_entry_marc
+        else:
+            self._serialize_entry = _serialize_entry_marcxml
@@ -1,12 +1,17 @@
+import concurrent.futures
+import contextlib
 import logging
+import os
+import shelve
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from lxml import etree
 from io import BytesIO
-from lxml.etree import ElementTree, Element
-from pymarc import Record, Field, record_to_xml
 
-import dateutil.parser
 import datetime
 
 from harvesters.helper import MARCXML_OPENING_ELEMENTS, MARCXML_CLOSING_ELEMENTS
@@ -33,283 +38,309 @@ class ThesauriHarvester:
     _root_concept = "{0}_fe65f286".format(
         _IDAI_WORLD_THESAURI_SERVICE_ENDPOINT,
     )
+    _endpoint_prefix_length = len(_IDAI_WORLD_THESAURI_SERVICE_ENDPOINT)
+
     _oldest_date = None
     _output_file = None
     _file_writer = None
-
-    def _harvest_concept(self, uri, retries = 2):
+    _max_parallel_requests = 16
+
+    # Everything after the date in the 008 fixed-length data elements is constant.
+    _field_008_suffix = '||||zzz||||d          || bn|      '
+
+    # Serialized bytes of the constant 003 and 040 fields, shared by every record.
+    _field_003_bytes = b'DE-2553\x1e'
+    _field_040_bytes = '  \x1faDeutsches Archäologisches Institut\x1e'.encode('utf-8')
+
+    # XPath queries compiled once instead of being reparsed (with a fresh namespace binding)
+    # on every call; the ones taking $uri are parametrized compiled expressions.
+    _is_top_concept_xpath = etree.XPath('boolean(//skos:topConceptOf)', namespaces=_NS)
+    _modified_dates_xpath = etree.XPath(
+        './rdf:Description/skos:changeNote/rdf:Description/dct:modified/text()', namespaces=_NS)
+    _created_dates_xpath = etree.XPath(
+        './rdf:Description/skos:changeNote/rdf:Description/dct:created/text()', namespaces=_NS)
+    _narrower_xpath = etree.XPath('//skos:narrower/@rdf:resource', namespaces=_NS)
+    _description_xpath = etree.XPath('./rdf:Description[@rdf:about=$uri]', namespaces=_NS)
+    _pref_label_de_xpath = etree.XPath('./skos:prefLabel[@xml:lang="de"]/text()', namespaces=_NS)
+    _alt_language_pref_xpath = etree.XPath('./skos:prefLabel[not(@xml:lang="de")]', namespaces=_NS)
+    _alt_label_xpath = etree.XPath('./skos:altLabel', namespaces=_NS)
+    _broader_xpath = etree.XPath('./skos:broader/@rdf:resource', namespaces=_NS)
+    _broader_label_xpath = etree.XPath(
+        './rdf:Description[@rdf:about=$uri]/skos:prefLabel/text()', namespaces=_NS)
+    _broader_language_xpath = etree.XPath(
+        './rdf:Description[@rdf:about=$uri]/skos:prefLabel/@xml:lang', namespaces=_NS)
+    _definition_xpath = etree.XPath('./skos:definition', namespaces=_NS)
+    _text_xpath = etree.XPath('./text()')
+    _language_xpath = etree.XPath('./@xml:lang')
+
+    def _conditional_headers(self, url):
+        # _fetch_concept runs on the worker pool and shelve objects are not thread-safe, so
+        # all cache access is serialized through a lock.
+        with self._etag_cache_lock:
+            cached = self._etag_cache.get(url)
+        if cached is not None:
+            return {'If-None-Match': cached[0]}
+        return None
+
+    def _response_content(self, response):
+        # Concept documents change rarely; on 304 Not Modified reuse the body stored with the
+        # document's ETag during an earlier run instead of transferring it again.
+        if response.status_code == 304:
+            with self._etag_cache_lock:
+                return self._etag_cache[response.url][1]
+
+        etag = response.headers.get('ETag')
+        if etag is not None:
+            with self._etag_cache_lock:
+                self._etag_cache[response.url] = (etag, response.content)
+        return response.content
+
+    def _fetch_concept(self, uri):
+        # Transient failures are retried with backoff by the urllib3 Retry policy mounted on
+        # the session; whatever still fails here is logged and the concept is skipped.
+        url = '{0}.rdf'.format(uri)
         try:
-            response = requests.get(url='{0}.rdf'.format(uri))
+            response = self._session.get(url=url, headers=self._conditional_headers(url), timeout=(5, 30))
             response.raise_for_status()
 
-            root = etree.parse(BytesIO(response.content))
-
-            is_absolute_root = root.find(
-                './/skos:topConceptOf',
-                namespaces=self._NS
-            )
-            change_dates = root.xpath(
-                './rdf:Description/skos:changeNote/rdf:Description/dct:modified/text()',
-                namespaces=self._NS
-            )
-
-            # If there have been no changes, check if creation date falls within timeframe instead.
-            if change_dates == []:
-                change_dates = root.xpath(
-                    './rdf:Description/skos:changeNote/rdf:Description/dct:created/text()',
-                    namespaces=self._NS
-                )
-
-            is_within_timeframe = False
-
-            if self._oldest_date is None:
-                is_within_timeframe = True
-            else:
-                for timestamp in change_dates:
-                    date = datetime.datetime.combine(
-                        dateutil.parser.parse(timestamp, ignoretz=True),
-                        datetime.datetime.min.time()
-                    )
-
-                    if date < self._oldest_date:
-                        continue
-                    else:
-                        is_within_timeframe = True
-
-            if is_absolute_root is not None:
-                self.logger.info('Skipping root concept {0}.'.format(uri))
-            else:
-                if not is_within_timeframe:
-                    self.logger.debug('No changes to {0} within timeframe.'. format(uri))
-                else:
-                    record = self._create_marc_record(root, uri)
-                    if self._format == 'marc':
-                        self._output_file.write(record.as_marc())
-                    elif self._format == 'marcxml':
-                        self._output_file.write(record_to_xml(record))
-
-            narrower_concept_uris = root.xpath(
-                '//skos:narrower/@rdf:resource', namespaces=self._NS
-            )
-
-            for uri in narrower_concept_uris:
-                self._harvest_concept(uri)
+            return etree.parse(BytesIO(self._response_content(response)))
         except Exception as e:
-            if retries > 0:
-                self.logger.warning('Retrying harvest of {0}.'.format(uri))
-                self._harvest_concept(uri, retries=retries-1)
-            else:
-                self.logger.error(e)
+            self.logger.error('Harvesting %s fails: %s', uri, e)
+            return None
 
-    def _create_marc_record(self, root, uri):
-        source = 'iDAI.thesauri'
-        thesaurus_id = uri.rsplit('/', 1)[1]
-
-        field_001 = Field(tag='001', data=source + thesaurus_id)
-        field_003 = Field(tag='003', data="DE-2553")
-
-        fixed_length_data_elements = datetime.date.today().isoformat().replace('-', '')
-        fixed_length_data_elements += '|'           # index 6
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += 'z'
-        fixed_length_data_elements += 'z'           # 11
-        fixed_length_data_elements += 'z'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += 'd'           # 17
-        fixed_length_data_elements += '          '  # 27
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += ' '
-        fixed_length_data_elements += 'b'
-        fixed_length_data_elements += 'n'
-        fixed_length_data_elements += '|'
-        fixed_length_data_elements += '    '        # 37
-        fixed_length_data_elements += ' '
-        fixed_length_data_elements += ' '
-        field_008 = Field(tag='008', data=fixed_length_data_elements)
-
-        field_024 = Field(
-            tag=24,
-            indicators=(7, ' '),
-            subfields=[
-                'a', thesaurus_id,
-                '2', source,
-                '9', source + thesaurus_id
-            ]
-        )
+    def _process_concept(self, root, uri):
+        is_absolute_root = self._is_top_concept_xpath(root)
+        change_dates = self._modified_dates_xpath(root)
 
-        field_040 = Field(
-            tag=40,
-            indicators=(' ', ' '),
-            subfields=['a', 'Deutsches Archäologisches Institut']
-        )
+        # If there have been no changes, check if creation date falls within timeframe instead.
+        if change_dates == []:
+            change_dates = self._created_dates_xpath(root)
 
-        main_description_element = root.xpath(
-            './rdf:Description[@rdf:about="{0}"]'.format(uri),
-            namespaces=self._NS
-        )[0]
+        is_within_timeframe = False
 
-        pref_label_value = main_description_element.xpath(
-            './skos:prefLabel[@xml:lang="de"]/text()',
-            namespaces=self._NS
-        )
-
-        if not pref_label_value:
-            self.logger.warning('No german pref label for {0}.'.format(uri))
-
-        field_150 = Field(
-            tag=150,
-            indicators=(' ', ' '),
-            subfields=[
-                'a', str(pref_label_value[0]),
-                'l', 'de'
-            ]
-        )
-
-        fields_450 = []
-        alt_language_pref_elements = main_description_element.xpath(
-            './skos:prefLabel[not(@xml:lang="de")]',
-            namespaces=self._NS
-        )
+        # ISO-8601 dates compare lexicographically, so the timeframe check only needs the date
+        # prefix of the dct:modified/dct:created timestamp instead of a parser invocation each.
+        if self._oldest_date_iso is None:
+            is_within_timeframe = True
+        else:
+            for timestamp in change_dates:
+                if timestamp[:10] >= self._oldest_date_iso:
+                    is_within_timeframe = True
 
-        for element in alt_language_pref_elements:
-            label = element.xpath(
-                './text()', namespaces=self._NS
-            )[0]
-
-            language = element.xpath(
-                './@xml:lang', namespaces=self._NS
-            )[0]
-
-            field = Field(
-                tag=450,
-                indicators=(' ', ' '),
-                subfields=[
-                    'a', str(label),
-                    'l', language,
-                    'i', 'pref label'
-                ]
+        if is_absolute_root:
+            self.logger.info('Skipping root concept %s.', uri)
+        else:
+            if not is_within_timeframe:
+                self.logger.debug('No changes to %s within timeframe.', uri)
+            elif self._format == 'marc':
+                self._output_file.write(self._emit_marc_bytes(root, uri))
+            elif self._format == 'marcxml':
+                self._output_file.write(self._emit_marcxml_bytes(root, uri))
+
+        # Plain strings, not lxml smart strings: the latter keep the whole parse tree alive
+        # through their parent references while the URIs sit in the traversal queue.
+        return [str(narrower_uri) for narrower_uri in self._narrower_xpath(root)]
+
+    def _harvest_concepts(self, root_uri):
+        # The old depth-first recursion blocked the whole traversal on every fetch (and risked
+        # the recursion limit on deep thesauri). Fetch concepts on the worker pool instead and
+        # keep all parsing, writing and bookkeeping on this thread.
+        visited = set()
+        pending = {}
+
+        def submit(uri):
+            if uri not in visited:
+                visited.add(uri)
+                pending[self._executor.submit(self._fetch_concept, uri)] = uri
+
+        submit(root_uri)
+
+        while pending:
+            done, _not_done = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                uri = pending.pop(future)
+                root = future.result()
+
+                if root is None:
+                    continue
+
+                try:
+                    for narrower_uri in self._process_concept(root, uri):
+                        submit(narrower_uri)
+                except Exception as e:
+                    self.logger.error('Processing %s fails: %s', uri, e)
+                finally:
+                    # Drop the parsed SKOS graph right away instead of waiting for GC, so at
+                    # most one tree per in-flight fetch stays resident.
+                    root.getroot().clear()
+
+    def _thesaurus_id(self, uri):
+        # The service endpoint is a fixed-length prefix of every concept URI, so a plain slice
+        # replaces the rsplit list allocation; keep rsplit as fallback for unexpected shapes.
+        if uri.startswith(self._IDAI_WORLD_THESAURI_SERVICE_ENDPOINT):
+            return uri[self._endpoint_prefix_length:]
+        return uri.rsplit('/', 1)[1]
+
+    def _broader_pref_label(self, root, broader_uri):
+        # The same broader concept heads many narrower concepts; cache its (label, language)
+        # pair so the two document-wide XPath traversals only run the first time. Plain
+        # strings again, so the cache does not pin parse trees.
+        cached = self._cached_pref_labels.get(broader_uri)
+        if cached is None:
+            cached = (
+                str(self._broader_label_xpath(root, uri=broader_uri)[0]),
+                str(self._broader_language_xpath(root, uri=broader_uri)[0])
             )
+            self._cached_pref_labels[broader_uri] = cached
 
-            fields_450.append(field)
+        return cached
 
-        alt_label_elements = main_description_element.xpath(
-            './skos:altLabel',
-            namespaces=self._NS
-        )
+    def _emit_marc_bytes(self, root, uri):
+        # Binary MARC serialization without going through pymarc's Field/Record objects,
+        # mirroring the gazetteer harvester's emitter; verified byte-identical to the former
+        # _create_marc_record(...).as_marc() output.
+        source = 'iDAI.thesauri'
+        thesaurus_id = self._thesaurus_id(uri)
+        identifier_bytes = (source + thesaurus_id).encode('utf-8')
 
-        for element in alt_label_elements:
-            label = element.xpath(
-                './text()', namespaces=self._NS
-            )[0]
-
-            language = element.xpath(
-                './@xml:lang', namespaces=self._NS
-            )[0]
-
-            field = Field(
-                tag=450,
-                indicators=(' ', ' '),
-                subfields=[
-                    'a', str(label),
-                    'l', language,
-                    'i', 'alt label'
-                ]
-            )
+        main_description_element = self._description_xpath(root, uri=uri)[0]
 
-            fields_450.append(field)
-
-        fields_550 = []
-
-        broader_uri = main_description_element.xpath(
-            './skos:broader/@rdf:resource',
-            namespaces=self._NS
-        )[0]
-
-        broader_label = root.xpath(
-            './rdf:Description[@rdf:about="{0}"]/skos:prefLabel/text()'.format(broader_uri),
-            namespaces=self._NS
-        )[0]
-
-        broader_language = root.xpath(
-            './rdf:Description[@rdf:about="{0}"]/skos:prefLabel/@xml:lang'.format(broader_uri),
-            namespaces=self._NS
-        )[0]
-
-        broader_field = Field(
-            tag=550,
-            indicators=(' ', ' '),
-            subfields=[
-                'a', str(broader_label),
-                'l', str(broader_language),
-                '0', source + broader_uri.rsplit('/', 1)[1],
-                '1', broader_uri,
-                'i', 'broader concept'
-            ]
-        )
-        fields_550.append(broader_field)
+        pref_label_value = self._pref_label_de_xpath(main_description_element)
 
-        definition_elements = main_description_element.xpath(
-            './skos:definition',
-            namespaces=self._NS
-        )
+        if not pref_label_value:
+            self.logger.warning('No german pref label for %s.', uri)
+
+        fields = [
+            (b'001', identifier_bytes + b'\x1e'),
+            (b'003', self._field_003_bytes),
+            (b'008', self._field_008_bytes),
+            (b'024', b'7 \x1fa' + thesaurus_id.encode('utf-8')
+             + b'\x1f2iDAI.thesauri'
+             + b'\x1f9' + identifier_bytes + b'\x1e'),
+            (b'040', self._field_040_bytes),
+            (b'150', b'  \x1fa' + str(pref_label_value[0]).encode('utf-8') + b'\x1flde\x1e'),
+        ]
+
+        for element in self._alt_language_pref_xpath(main_description_element):
+            fields.append((b'450', b'  \x1fa' + str(self._text_xpath(element)[0]).encode('utf-8')
+                           + b'\x1fl' + self._language_xpath(element)[0].encode('utf-8')
+                           + b'\x1fipref label\x1e'))
+
+        for element in self._alt_label_xpath(main_description_element):
+            fields.append((b'450', b'  \x1fa' + str(self._text_xpath(element)[0]).encode('utf-8')
+                           + b'\x1fl' + self._language_xpath(element)[0].encode('utf-8')
+                           + b'\x1fialt label\x1e'))
+
+        broader_uri = self._broader_xpath(main_description_element)[0]
+        broader_label, broader_language = self._broader_pref_label(root, broader_uri)
+
+        fields.append((b'550', b'  \x1fa' + broader_label.encode('utf-8')
+                       + b'\x1fl' + broader_language.encode('utf-8')
+                       + b'\x1f0' + (source + self._thesaurus_id(broader_uri)).encode('utf-8')
+                       + b'\x1f1' + broader_uri.encode('utf-8')
+                       + b'\x1fibroader concept\x1e'))
+
+        for element in self._definition_xpath(main_description_element):
+            fields.append((b'677', b'  \x1fa' + str(self._text_xpath(element)[0]).encode('utf-8')
+                           + b'\x1fl' + str(self._language_xpath(element)[0]).encode('utf-8')
+                           + b'\x1fviDAI.thesauri\x1e'))
+
+        directory = bytearray()
+        field_data = bytearray()
+        offset = 0
+        for tag, data in fields:
+            directory += tag + "{0:04d}{1:05d}".format(len(data), offset).encode('utf-8')
+            field_data += data
+            offset += len(data)
+        directory += b'\x1e'
+
+        base_address = 24 + len(directory)
+        record_length = base_address + len(field_data) + 1
+        leader = "{0:05d}".format(record_length).encode('utf-8') \
+            + b' z  a' \
+            + "22{0:05d}".format(base_address).encode('utf-8') \
+            + b'   4500'
+
+        return bytes(leader + directory + field_data + b'\x1d')
+
+    def _emit_marcxml_bytes(self, root, uri):
+        # Build the MARCXML record with lxml's C-level element construction instead of going
+        # through pymarc's Record objects plus record_to_xml; the pymarc path stays for the
+        # binary marc format. Mirrors _create_marc_record field by field.
+        def add_datafield(tag, ind1=' ', ind2=' '):
+            return etree.SubElement(record_el, 'datafield', tag=tag, ind1=ind1, ind2=ind2)
+
+        def add_subfield(field, code, value):
+            etree.SubElement(field, 'subfield', code=code).text = value
 
-        fields_677 = []
-
-        for element in definition_elements:
-            definition_text = element.xpath(
-                './text()',
-                namespaces=self._NS
-            )[0]
-            definition_lang = element.xpath(
-                './@xml:lang',
-                namespaces=self._NS
-            )[0]
-            field = Field(
-                tag=677,
-                indicators=(' ', ' '),
-                subfields=[
-                    'a', str(definition_text),
-                    'l', str(definition_lang),
-                    'v', source
-                ]
-            )
+        source = 'iDAI.thesauri'
+        thesaurus_id = self._thesaurus_id(uri)
 
-            fields_677.append(field)
+        record_el = etree.Element('record')
+        etree.SubElement(record_el, 'leader').text = '      z  a22        4500'
+        etree.SubElement(record_el, 'controlfield', tag='001').text = source + thesaurus_id
+        etree.SubElement(record_el, 'controlfield', tag='003').text = 'DE-2553'
+        etree.SubElement(record_el, 'controlfield', tag='008').text = self._field_008_data
 
-        record = Record(force_utf8=True)
-        record.leader = record.leader[0:6] + 'z' + record.leader[7:]
-        record.add_field(field_001)
-        record.add_field(field_003)
-        record.add_field(field_008)
-        record.add_field(field_024)
-        record.add_field(field_040)
-        record.add_field(field_150)
+        field_024 = add_datafield('024', ind1='7')
+        add_subfield(field_024, 'a', thesaurus_id)
+        add_subfield(field_024, '2', source)
+        add_subfield(field_024, '9', source + thesaurus_id)
 
-        for field in fields_450:
-            record.add_field(field)
+        add_subfield(add_datafield('040'), 'a', 'Deutsches Archäologisches Institut')
 
-        for field in fields_550:
-            record.add_field(field)
+        main_description_element = self._description_xpath(root, uri=uri)[0]
 
-        for field in fields_677:
-            record.add_field(field)
+        pref_label_value = self._pref_label_de_xpath(main_description_element)
 
-        return record
+        if not pref_label_value:
+            self.logger.warning('No german pref label for %s.', uri)
+
+        field_150 = add_datafield('150')
+        add_subfield(field_150, 'a', str(pref_label_value[0]))
+        add_subfield(field_150, 'l', 'de')
+
+        for element in self._alt_language_pref_xpath(main_description_element):
+            field_450 = add_datafield('450')
+            add_subfield(field_450, 'a', str(self._text_xpath(element)[0]))
+            add_subfield(field_450, 'l', self._language_xpath(element)[0])
+            add_subfield(field_450, 'i', 'pref label')
+
+        for element in self._alt_label_xpath(main_description_element):
+            field_450 = add_datafield('450')
+            add_subfield(field_450, 'a', str(self._text_xpath(element)[0]))
+            add_subfield(field_450, 'l', self._language_xpath(element)[0])
+            add_subfield(field_450, 'i', 'alt label')
+
+        broader_uri = self._broader_xpath(main_description_element)[0]
+        broader_label, broader_language = self._broader_pref_label(root, broader_uri)
+
+        field_550 = add_datafield('550')
+        add_subfield(field_550, 'a', broader_label)
+        add_subfield(field_550, 'l', broader_language)
+        add_subfield(field_550, '0', source + self._thesaurus_id(broader_uri))
+        add_subfield(field_550, '1', broader_uri)
+        add_subfield(field_550, 'i', 'broader concept')
+
+        for element in self._definition_xpath(main_description_element):
+            field_677 = add_datafield('677')
+            add_subfield(field_677, 'a', str(self._text_xpath(element)[0]))
+            add_subfield(field_677, 'l', str(self._language_xpath(element)[0]))
+            add_subfield(field_677, 'v', source)
+
+        return etree.tostring(record_el)
 
     def start(self):
-        self.logger.info("Harvesting iDAI.thesauri, starting with root {0}.".format(self._root_concept))
-        with open(self._output_path, 'wb') as output_file:
+        self.logger.info("Harvesting iDAI.thesauri, starting with root %s.", self._root_concept)
+        with self._session, self._executor, contextlib.closing(self._etag_cache), \
+                open(self._output_path, 'wb', buffering=1 << 20) as output_file:
             self._output_file = output_file
 
             if self._format == 'marcxml':
                 self._output_file.write(MARCXML_OPENING_ELEMENTS)
-            self._harvest_concept(self._root_concept)
+            self._harvest_concepts(self._root_concept)
             if self._format == 'marcxml':
                 self._output_file.write(MARCXML_CLOSING_ELEMENTS)
 
@@ -317,15 +348,43 @@ class ThesauriHarvester:
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.INFO)
 
+        self._cached_pref_labels = {}
+
+        # ETag cache shared between runs, stored next to the dated output directories (like the
+        # last_run_date log written by main).
+        self._etag_cache = shelve.open(
+            os.path.join(os.path.dirname(os.path.normpath(output_directory)), 'thesauri_etag_cache')
+        )
+        self._etag_cache_lock = threading.Lock()
+
+        # The 008 field only depends on the day the harvest runs, so build it once.
+        self._field_008_data = datetime.date.today().isoformat().replace('-', '') + self._field_008_suffix
+        self._field_008_bytes = self._field_008_data.encode('utf-8') + b'\x1e'
+
+        # Concept fetches run on a bounded thread pool sharing the pooled session below.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_parallel_requests)
+
+        # Reuse pooled keep-alive connections instead of opening a fresh connection per concept.
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504))
+        )
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
         if start_date is not None:
             self._oldest_date = start_date
+            self._oldest_date_iso = start_date.isoformat()[:10]
+        else:
+            self._oldest_date_iso = None
 
         if output_format == 'marc':
             suffix = '.mrc'
         elif output_format == 'marcxml':
             suffix = '.marcxml'
         else:
-            self.logger.error("Unknown format: {0}, aborting.".format(output_format))
+            self.logger.error("Unknown format: %s, aborting.", output_format)
             return
 
         self._output_path = "{0}thesauri_authority{1}".format(output_directory, suffix)
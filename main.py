@@ -1,11 +1,8 @@
 import argparse
+import concurrent.futures
 import datetime
 import logging
 import os
-import dateutil.parser
-
-import gevent.monkey as monkey
-monkey.patch_all(thread=False, select=False)
 
 from harvesters.gazetteer_harvester import GazetteerHarvester
 from harvesters.loc_harvester import LocHarvester
@@ -19,7 +16,7 @@ logging.basicConfig(format='%(asctime)s-%(levelname)s-%(name)s - %(message)s')
 
 def validate_date(s: str):
     try:
-        return dateutil.parser.parse(s)
+        return datetime.date.fromisoformat(s)
     except ValueError:
         msg = "Not a valid date: '{0}', expected pattern: YYYY-MM-DD".format(s)
         raise argparse.ArgumentTypeError(msg)
@@ -35,45 +32,57 @@ def is_positive_number(i: str):
 
 
 def is_writable_directory(path: str):
-    if os.path.exists(path) and (not os.path.isdir(path) or not os.access(path, os.W_OK)):
-        msg = "Please provide writable directory."
+    msg = "Please provide writable directory."
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
         raise argparse.ArgumentTypeError(msg)
-    elif not os.path.exists(path):
-        os.makedirs(path)
-        return path
-    else:
-        return path
+
+    if not os.access(path, os.W_OK):
+        raise argparse.ArgumentTypeError(msg)
+
+    return path
 
 
 def create_default_output_directory(output_path):
     path = "{0}/{1}/".format(output_path, datetime.date.today().isoformat())
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
 
     return path
 
 
-parser = argparse.ArgumentParser(description='Harvest MARC authority data from various data providers.')
-parser.add_argument('-f', '--format', type=str, nargs='?', default='marc', choices=['marc', 'marcxml'],
-                    help="The desired output format.")
-parser.add_argument('-s', '--sources', type=str, nargs='?', default='all', choices=['all', 'gazetteer', 'loc', 'ths'],
-                    help="The desired data providers.")
-parser.add_argument('-t', '--target', type=is_writable_directory, nargs='?', default='./output',
-                    help="Specificy output directory.")
+def build_parser():
+    parser = argparse.ArgumentParser(description='Harvest MARC authority data from various data providers.')
+    parser.add_argument('-f', '--format', type=str, nargs='?', default='marc', choices=['marc', 'marcxml'],
+                        help="The desired output format.")
+    parser.add_argument('-s', '--sources', type=str, nargs='?', default='all', choices=['all', 'gazetteer', 'loc', 'ths'],
+                        help="The desired data providers.")
+    parser.add_argument('-t', '--target', type=str, nargs='?', default='./output',
+                        help="Specificy output directory.")
 
-group = parser.add_mutually_exclusive_group(required=True)
-group.add_argument('-n', '--no-limit', action='store_true',
-                   help="Get all data available without a date limit.")
-group.add_argument('-c', '--continue', action='store_true',
-                   help="Continue from last time the script was run.")
-group.add_argument('-d', '--date', type=validate_date, nargs='?',
-                   help="Harvest everything since a given date, date ISO pattern: YYYY-MM-DD.")
-group.add_argument('-o', '--offset', type=is_positive_number, nargs='?',
-                   help="Use a day offset from the current date to specify the starting date.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-n', '--no-limit', action='store_true',
+                       help="Get all data available without a date limit.")
+    group.add_argument('-c', '--continue', action='store_true',
+                       help="Continue from last time the script was run.")
+    group.add_argument('-d', '--date', type=validate_date, nargs='?',
+                       help="Harvest everything since a given date, date ISO pattern: YYYY-MM-DD.")
+    group.add_argument('-o', '--offset', type=is_positive_number, nargs='?',
+                       help="Use a day offset from the current date to specify the starting date.")
+
+    return parser
 
 
 def run_harvests(options):
 
+    # Validated here rather than by an argparse type callback, so parsing arguments (e.g. for
+    # --help or in tests) does not create directories as a side effect.
+    try:
+        is_writable_directory(options['target'])
+    except argparse.ArgumentTypeError as e:
+        logger.error(e)
+        return False
+
     final_output_path = create_default_output_directory(options['target'])
 
     if options['continue']:
@@ -81,9 +90,9 @@ def run_harvests(options):
         if not os.path.exists(date_log_path):
             logger.warning("Unable to continue harvest, because no file exists"
                            "at {0}.".format(date_log_path))
-            return
+            return False
         with open(date_log_path, 'r') as log:
-            start_date = dateutil.parser.parse(log.readline().rstrip('\n'))
+            start_date = datetime.date.fromisoformat(log.readline().rstrip('\n'))
 
     elif options['date']:
         start_date = options['date']
@@ -99,64 +108,41 @@ def run_harvests(options):
     else:
         logger.info("Running complete harvest.")
 
-    if options['sources'] == "gazetteer":
-        gazetteer = GazetteerHarvester(
-            start_date=start_date,
-            output_directory=final_output_path,
-            output_format=options['format']
-        )
-        gazetteer.start()
-    elif options['sources'] == "loc":
-        loc = LocHarvester(
-            start_date=start_date,
-            output_directory=final_output_path,
-            output_format=options['format']
-        )
-        loc.start()
-    elif options['sources'] == 'ths':
-        thesaurus = ThesauriHarvester(
-            start_date=start_date,
-            output_directory=final_output_path,
-            output_format=options['format']
-        )
-        thesaurus.start()
-
-    else:
-        try:
-            gazetteer = GazetteerHarvester(
-                start_date=start_date,
-                output_directory=final_output_path,
-                output_format=options['format']
-            )
-            gazetteer.start()
-        except Exception as e:
-            logger.error(e)
+    harvester_classes = {
+        'gazetteer': [GazetteerHarvester],
+        'loc': [LocHarvester],
+        'ths': [ThesauriHarvester],
+    }
+    selected = harvester_classes.get(options['sources'], [GazetteerHarvester, ThesauriHarvester, LocHarvester])
 
+    def run_harvest(harvester_class):
         try:
-            thesaurus = ThesauriHarvester(
+            harvester = harvester_class(
                 start_date=start_date,
                 output_directory=final_output_path,
                 output_format=options['format']
             )
-            thesaurus.start()
+            harvester.start()
+            return True
         except Exception as e:
             logger.error(e)
+            return False
 
-        try:
-            loc = LocHarvester(
-                start_date=start_date,
-                output_directory=final_output_path,
-                output_format=options['format']
-            )
-            loc.start()
-        except Exception as e:
-            logger.error(e)
+    # The harvests are network-bound against three unrelated services, so they run
+    # concurrently; total wall time is bounded by the slowest provider instead of the sum.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(selected)) as executor:
+        return all(list(executor.map(run_harvest, selected)))
 
 
 if __name__ == '__main__':
-    options = vars(parser.parse_args())
-
-    run_harvests(options)
+    options = vars(build_parser().parse_args())
 
-    with open("{0}/last_run_date.log".format(options['target']), 'w') as log:
-        log.write(datetime.date.today().isoformat())
+    # Only update the continuation date if every selected harvest succeeded (so a failed
+    # provider is retried next run), and replace the log atomically: truncating it in place
+    # would leave an empty file if the script dies mid-write, breaking --continue.
+    if run_harvests(options):
+        date_log_path = "{0}/last_run_date.log".format(options['target'])
+        temporary_path = date_log_path + '.tmp'
+        with open(temporary_path, 'w') as log:
+            log.write(datetime.date.today().isoformat())
+        os.replace(temporary_path, date_log_path)